@@ -14,62 +14,40 @@ exec python -- "$0" ${1+"$@"}; exit 1
 # displayed incurrectly (but the files are processed correctly).
 #
 
+import codecs
+import errno
 import os
 import os.path
+import signal
 import stat
 import struct
 import sys
 
 
-def maybe_encode_pathname(pathname):  # Python 2 only.
-  if not isinstance(pathname, unicode):
-    raise TypeError
-  filesystem_encoding = get_filesystem_encoding()
-  try:
-    return pathname.encode(filesystem_encoding)
-  except (UnicodeEncodeError, ValueError):
-    raise ValueError('Cannot encode pathname as %s: %r' % (filesystem_encoding, pathname))
-
-
+# pathname_to_os and pathnames_from_os are called for each file, so they
+# don't check the type of their arguments.
 if sys.version_info >= (3, 0):  # No need for pathname encodings in Python 3.
-  def maybe_encode_pathname(pathname):
-    if not isinstance(pathname, str):
-      raise TypeError
-    return pathname
-
   def pathname_to_os(pathname):
-    if not isinstance(pathname, str):
-      raise TypeError
     return pathname
 
-  def pathnames_from_os(pathnames):
-    output = []
-    for pathname in pathnames:
-      if not isinstance(pathname, str):
-        raise TypeError
-      output.append(pathname)
-    return output
+  pathnames_from_os = maybe_encode_pathname = pathname_to_os
 
   def pathname_from_argv(pathname):
     if not isinstance(pathname, str):
       raise TypeError
     return pathname
 
+  def pathname_from_ascii(data):
+    return data.decode('ascii')  # Raises UnicodeDecodeError if not ASCII.
+
   def get_filesystem_encoding():
     raise NotImplementedError
 elif sys.platform.startswith('win'):
-  def pathname_to_os(pathname):
-    if not isinstance(pathname, str):
-      raise TypeError
-    return pathname.decode('utf-8')  # Returns unicode.
+  def pathname_to_os(pathname, _decode=codecs.lookup('utf-8')[1]):
+    return _decode(pathname)[0]  # Returns unicode.
 
-  def pathnames_from_os(pathnames):
-    output = []
-    for pathname in pathnames:
-      if not isinstance(pathname, unicode):
-        raise TypeError
-      output.append(pathname.encode('utf-8'))  # str.
-    return output
+  def pathnames_from_os(pathnames, _encode=codecs.lookup('utf-8')[0]):
+    return [_encode(pathname)[0] for pathname in pathnames]  # List of str.
 
   def pathname_from_argv(pathname):
     if not isinstance(pathname, str):
@@ -77,29 +55,29 @@ elif sys.platform.startswith('win'):
     mb = pathname.decode('mbcs')  # Windows-specific.
     return mb.encode('utf-8')  # Returns str.
 
+  def pathname_from_ascii(data):
+    data.decode('ascii')  # Raises UnicodeDecodeError if not ASCII.
+    return data  # Returns str, ASCII is also valid UTF-8.
+
   def get_filesystem_encoding():
     return 'utf-8'  # Fake, to be used with pathname_to_os.
 
   # Console message will still be wrong (using UTF-8 encoding).
 else:
   def pathname_to_os(pathname):
-    if not isinstance(pathname, str):
-      raise TypeError
     return pathname  # Returns str.
 
-  def pathnames_from_os(pathnames):
-    output = []
-    for pathname in pathnames:
-      if not isinstance(pathname, str):
-        raise TypeError
-      output.append(pathname)
-    return output
+  pathnames_from_os = pathname_to_os
 
   def pathname_from_argv(pathname):
     if not isinstance(pathname, str):
       raise TypeError
     return pathname  # Returns str.
 
+  def pathname_from_ascii(data):
+    data.decode('ascii')  # Raises UnicodeDecodeError if not ASCII.
+    return data  # Returns str, the filesystem encoding is ASCII-compatible.
+
   def get_filesystem_encoding(_cache=[]):
     if not _cache:
       fsenc = sys.getfilesystemencoding().lower()  # 'ANSI_X3.4-1968' for LC_CTYPE=C on Linux.
@@ -111,6 +89,18 @@ else:
     return _cache[0]
 
 
+if sys.version_info < (3, 0):
+  FILESYSTEM_ENCODING = get_filesystem_encoding()
+
+  def maybe_encode_pathname(pathname, _enc=FILESYSTEM_ENCODING):
+    if not isinstance(pathname, unicode):
+      raise TypeError
+    try:
+      return pathname.encode(_enc)
+    except (UnicodeEncodeError, ValueError):
+      raise ValueError('Cannot encode pathname as %s: %r' % (_enc, pathname))
+
+
 if sys.platform.startswith('win'):
   try:
     os.lstat
@@ -118,108 +108,434 @@ if sys.platform.startswith('win'):
     os.lstat = os.stat  # Not needed in Python 2.6.
 
 
-def parse_recycle_bin_i_file(filename):
-  # Based on: https://stackoverflow.com/q/66939004
-  f = open(pathname_to_os(filename), 'rb')
-  try:
-    data = f.read(0x18)
-    if len(data) != 0x18:
-      raise ValueError('EOF in Recycle Bin $I file header.')
-    version, size, deletion_filetime = struct.unpack('<QQQ', data)
-    if version == 1:
-      deleted_pathname = f.read(520)
-    elif version == 2:
-      data = f.read(4)
-      if len(data) != 4:
-        raise ValueError('EOF in deleted_pathname size.')
-      deleted_pathname_size, = struct.unpack('<L', data)
-      if deleted_pathname_size > 0x1000:
-        raise ValueError('deleted_pathname too long.')
-      deleted_pathname = f.read(deleted_pathname_size << 1)
-    else:
-      raise ValueError('Bad Recycle Bin $I signature: version=%d' % version)
-  finally:
-    f.close()
+try:
+  struct.Struct
+except AttributeError:  # Python 2.4.
+  class _Struct(object):
+    def __init__(self, fmt):
+      self.format = fmt
+      self.size = struct.calcsize(fmt)
+
+    def unpack_from(self, data, offset=0):
+      return struct.unpack(self.format, data[offset : offset + self.size])
+else:
+  _Struct = struct.Struct
+
+_I_HEADER = _Struct('<QQQ')
+_I_PLEN = _Struct('<L')
+_NUL = '\0'.encode('ascii')  # b'\0', but also works in Python 2.4 and 2.5.
+_UTF16_NUL = _NUL * 2
+
+
+def find_utf16le_nul(data):
+  """Returns the (even) byte offset of the first UTF-16LE NUL in data, or -1."""
+  i = data.find(_UTF16_NUL)
+  while i >= 0 and i & 1:
+    i = data.find(_UTF16_NUL, i + 1)
+  return i
+
+
+class LstatDirEntry(object):
+  """Minimal os.DirEntry replacement based on os.lstat, for Python <3.5."""
+
+  def __init__(self, dirpathname, name):
+    self.name = name
+    self.path = os.path.join(dirpathname, name)
+    self._stat_obj = None
+
+  def stat(self, follow_symlinks=True):
+    # Always behaves like follow_symlinks=False, that's all we need.
+    if self._stat_obj is None:
+      self._stat_obj = os.lstat(pathname_to_os(self.path))
+    return self._stat_obj
+
+  def is_dir(self, follow_symlinks=True):
+    try:
+      return stat.S_ISDIR(self.stat().st_mode)
+    except OSError:
+      return False
+
+  def is_file(self, follow_symlinks=True):
+    try:
+      return stat.S_ISREG(self.stat().st_mode)
+    except OSError:
+      return False
+
+
+def get_entry_name(entry):
+  return entry.name
+
+
+if getattr(os, 'scandir', None):  # Python >=3.5.
+  def list_dir_entries(pathname, do_sort=False):
+    """Returns an iterable of os.DirEntry objects in a directory.
+
+    With os.scandir, is_dir() and is_file() usually don't need a system call.
+    If do_sort is false, the entries are returned in directory order,
+    without building a list.
+    """
+    entries = os.scandir(pathname_to_os(pathname))
+    if do_sort:
+      entries = list(entries)
+      entries.sort(key=get_entry_name)
+    return entries
+else:
+  def list_dir_entries(pathname, do_sort=False):
+    """Returns a list of LstatDirEntry objects in a directory."""
+    entries = [LstatDirEntry(pathname, name) for name in
+               pathnames_from_os(os.listdir(pathname_to_os(pathname)))]
+    if do_sort:
+      entries.sort(key=get_entry_name)
+    return entries
+
+
+def decode_utf16le_pathname(data):
+  """Returns the pathname in UTF-16LE data, for use with pathname_to_os."""
+  high_bytes = data[1::2]
+  if high_bytes.count(_NUL) == len(high_bytes):  # Fast path for ASCII.
+    try:
+      return pathname_from_ascii(data[0::2])
+    except UnicodeDecodeError:
+      pass
   try:
-    deleted_pathname = deleted_pathname.decode('utf-16le')
+    pathname = data.decode('utf-16le')
   except (UnicodeDecodeError, ValueError):
-    raise ValueError('Bad UTF-16LE pathname: %r' % deleted_pathname)
-  deleted_pathname = maybe_encode_pathname(deleted_pathname)
-  i = deleted_pathname.find('\0')
+    raise ValueError('Bad UTF-16LE pathname: %r' % data)
+  return maybe_encode_pathname(pathname)
+
+
+def get_i_v1_pathname_data(data):  # Windows Vista, 7, 8.
+  deleted_pathname = data[0x18 : 0x18 + 520]
+  i = find_utf16le_nul(deleted_pathname)
   if i < 0:
     raise ValueError('Missing trailing NUL in deleted_pathname.')
-  deleted_pathname = deleted_pathname[:i]
+  return deleted_pathname[:i]
+
+
+def get_i_v2_pathname_data(data):  # Windows 10 and later.
+  if len(data) < 0x1c:
+    raise ValueError('EOF in deleted_pathname size.')
+  deleted_pathname_size, = _I_PLEN.unpack_from(data, 0x18)
+  if deleted_pathname_size > 0x1000:
+    raise ValueError('deleted_pathname too long.')
+  deleted_pathname = data[0x1c : 0x1c + (deleted_pathname_size << 1)]
+  if len(deleted_pathname) != deleted_pathname_size << 1:
+    raise ValueError('EOF in deleted_pathname.')
+  i = find_utf16le_nul(deleted_pathname)  # Usually the last character.
+  if i >= 0:
+    deleted_pathname = deleted_pathname[:i]
+  return deleted_pathname
+
+
+# Maps the $I file version to a function returning the UTF-16LE pathname
+# without the trailing NUL.
+_I_PATHNAME_DATA_GETTERS = {1: get_i_v1_pathname_data, 2: get_i_v2_pathname_data}
+
+
+def parse_recycle_bin_i_header(filename):
+  """Returns (size, deletion_filetime, pathname_data) of an $I file.
+
+  pathname_data is the undecoded UTF-16LE pathname, to be passed to
+  decode_recycle_bin_i_pathname.
+  """
+  # Based on: https://stackoverflow.com/q/66939004
+  # Unbuffered, so that f.read(...) is a single read(2) call. A buffered
+  # file would keep reading until EOF, because the size is above its buffer.
+  f = open(pathname_to_os(filename), 'rb', 0)
+  try:
+    data = f.read(0x1c + 0x2000)  # Longest possible $I file.
+  finally:
+    f.close()
+  if len(data) < 0x18:
+    raise ValueError('EOF in Recycle Bin $I file header.')
+  version, size, deletion_filetime = _I_HEADER.unpack_from(data)
+  get_pathname_data = _I_PATHNAME_DATA_GETTERS.get(version)
+  if get_pathname_data is None:
+    raise ValueError('Bad Recycle Bin $I signature: version=%d' % version)
+  return size, deletion_filetime, get_pathname_data(data)
+
+
+def decode_recycle_bin_i_pathname(pathname_data):
+  """Returns the restore pathname relative to the restore target dir."""
+  deleted_pathname = decode_utf16le_pathname(pathname_data)
   if len(deleted_pathname) < 3:
     raise ValueError('deleted_pathame too short: %r' % deleted_pathname)
   if not deleted_pathname[0].isalpha():
     raise ValueError('Bad drive letter in deleted_pathname: %r' % deleted_pathname)
   if deleted_pathname[1 : 3] != ':\\':
     raise ValueError('Missing drive separator in deleted_pathname: %r' % deleted_pathname)
-  deleted_pathname = os.path.join(*filter(None, (
-      deleted_pathname[0].lower() + deleted_pathname[2:]).split('\\')))
+  drive_letter = deleted_pathname[0].lower()
+  deleted_pathname = deleted_pathname[3:].strip('\\')
+  while '\\\\' in deleted_pathname:  # Rare: remove empty pathname components.
+    deleted_pathname = deleted_pathname.replace('\\\\', '\\')
+  if deleted_pathname:
+    if os.sep != '\\':
+      deleted_pathname = deleted_pathname.replace('\\', os.sep)
+    deleted_pathname = drive_letter + os.sep + deleted_pathname
+  else:
+    deleted_pathname = drive_letter
+  return deleted_pathname
+
+
+def parse_recycle_bin_i_file(filename):
+  size, deletion_filetime, pathname_data = parse_recycle_bin_i_header(filename)
+  deleted_pathname = decode_recycle_bin_i_pathname(pathname_data)
   #assert 0, [size, deletion_filetime, deleted_pathname]
   return size, deletion_filetime, deleted_pathname
 
 
-def filetime_to_timestamp_float(filetime):
+def filetime_to_timestamp_float(filetime, _windows_tick=10000000.,
+                                _sec_to_unix_epoch=11644473600):
   """Convert a Windows FILETIME (64-bit integer) to a Unix timestamp float."""
   # Based on: https://stackoverflow.com/a/6161842
-  WINDOWS_TICK = 10000000.
-  SEC_TO_UNIX_EPOCH = 11644473600
-  return (filetime / WINDOWS_TICK) - SEC_TO_UNIX_EPOCH
+  return (filetime / _windows_tick) - _sec_to_unix_epoch
+
+
+def filetime_to_unix_ns(filetime):
+  """Convert a Windows FILETIME (64-bit integer) to Unix nanoseconds (int)."""
+  return filetime * 100 - 11644473600 * 1000000000
+
+
+if sys.version_info >= (3, 3):  # os.utime(..., ns=...) and .st_mtime_ns.
+  def set_mtime_if_earlier(os_pathname, stat_obj, filetime):
+    """Sets the mtime to filetime if that's earlier, without rounding."""
+    mtime_ns = filetime_to_unix_ns(filetime)
+    if mtime_ns < stat_obj.st_mtime_ns:
+      os.utime(os_pathname, ns=(stat_obj.st_atime_ns, mtime_ns))
+else:
+  def set_mtime_if_earlier(os_pathname, stat_obj, filetime):
+    """Sets the mtime to filetime if that's earlier."""
+    mtime = filetime_to_timestamp_float(filetime)
+    if mtime < stat_obj.st_mtime:
+      os.utime(os_pathname, (stat_obj.st_atime, mtime))
+
+
+def get_lstat_type_os(os_pathname):
+  """Returns the S_IFMT bits of an OS pathname, or None if it doesn't exist.
+
+  Doesn't follow symlinks.
+  """
+  try:
+    return stat.S_IFMT(os.lstat(os_pathname).st_mode)
+  except OSError:
+    return None
+
+
+def get_lstat_type(pathname):
+  return get_lstat_type_os(pathname_to_os(pathname))
+
+
+# Cache of positive lexists results in this run. Restored files are never
+# removed (not even by other processes), so these stay valid. Negative
+# results aren't cached: a missing pathname is probed only once before a
+# file is created, which may make it (or, on a case-insensitive
+# filesystem, a differently spelled pathname) exist.
+_STAT_CACHE = {}  # Maps pathname to the S_IFMT bits.
+
+
+# Functions called for each file get the globals they use bound as default
+# arguments (e.g. _stat_cache=_STAT_CACHE), which are faster to look up.
+def lexists(pathname, _stat_cache=_STAT_CACHE, _get_lstat_type=get_lstat_type):
+  """Like os.path.lexists, but doesn't follow symlinks on any platform."""
+  if pathname in _stat_cache:
+    return True
+  file_type = _get_lstat_type(pathname)
+  if file_type is None:
+    return False
+  _stat_cache[pathname] = file_type
+  return True
+
+
+# A multiprocessing lock held while picking a free restore pathname and
+# moving the file there, or None if there is only a single process.
+_RESTORE_LOCK = None
+
 
+def set_restore_lock(lock):
+  global _RESTORE_LOCK
+  _RESTORE_LOCK = lock
 
-def process_recycle_bin_pathname(pathname, restore_target_dir):
-  basename = os.path.basename(pathname)
-  if not basename.startswith('$I'):
+
+def init_worker(lock):  # Runs in each multiprocessing worker.
+  # Ctrl-C is handled by the parent, which terminates the pool.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  set_restore_lock(lock)
+
+
+def move_to_restore_pathname(
+    r_pathname, restore_pathname, stat_obj, _lexists=lexists,
+    _splitext=os.path.splitext, _rename=os.rename, _dirname=os.path.dirname,
+    _makedirs=os.makedirs, _isdir=os.path.isdir, _S_IFMT=stat.S_IFMT,
+    _ENOENT=errno.ENOENT, _pathname_to_os=pathname_to_os,
+    _stat_cache=_STAT_CACHE):
+  """Moves r_pathname to restore_pathname, or to a free variant of it."""
+  # sys.stderr is looked up each time (not bound), it may be replaced.
+  if _lexists(restore_pathname):
+    # Find a free '%s-%d%s' pathname with O(log n) probes: double the
+    # number until it's free, then binary search. If there are no gaps in
+    # the numbers, this finds the same pathname as a linear search.
+    prefix, ext = _splitext(restore_pathname)
+    lo, hi = 0, 1  # Invariant: lo is taken (or 0), hi is free.
+    while _lexists('%s-%d%s' % (prefix, hi, ext)):
+      lo, hi = hi, hi << 1
+    while hi - lo > 1:
+      mid = (lo + hi) >> 1
+      if _lexists('%s-%d%s' % (prefix, mid, ext)):
+        lo = mid
+      else:
+        hi = mid
+    restore_pathname = '%s-%d%s' % (prefix, hi, ext)
+  # A single write call, so both lines are written together.
+  sys.stderr.write('info: moving from Recycle Bin: %s\ninfo: moving to: %s\n'
+                   % (r_pathname, restore_pathname))
+  try:  # Usually the restore directory exists, try without os.makedirs.
+    _rename(_pathname_to_os(r_pathname), _pathname_to_os(restore_pathname))
+  except OSError:
+    if sys.exc_info()[1].errno != _ENOENT:
+      raise
+    restore_dirname = _dirname(restore_pathname)
+    try:
+      _makedirs(_pathname_to_os(restore_dirname))
+    except OSError:
+      if not _isdir(_pathname_to_os(restore_dirname)):
+        raise
+    _rename(_pathname_to_os(r_pathname), _pathname_to_os(restore_pathname))
+  _stat_cache[restore_pathname] = _S_IFMT(stat_obj.st_mode)
+  _stat_cache.pop(r_pathname, None)
+
+
+def process_recycle_bin_pathname(
+    i_entry, r_entry, restore_target_dir, _S_ISREG=stat.S_ISREG,
+    _join=os.path.join, _remove=os.remove, _pathname_to_os=pathname_to_os,
+    _stat_cache=_STAT_CACHE,
+    _parse_recycle_bin_i_header=parse_recycle_bin_i_header,
+    _decode_recycle_bin_i_pathname=decode_recycle_bin_i_pathname,
+    _set_mtime_if_earlier=set_mtime_if_earlier,
+    _move_to_restore_pathname=move_to_restore_pathname):
+  pathname = i_entry.path
+  if not i_entry.name.startswith('$I'):
     raise ValueError('Expected Recycle Bin $I pathname: %s' % pathname)
-  r_pathname = os.path.join(os.path.dirname(pathname), '$R' + basename[2:])
+  r_pathname = r_entry.path
   try:
-    stat_obj = os.lstat(pathname_to_os(r_pathname))
+    stat_obj = r_entry.stat(follow_symlinks=False)  # Free on Windows.
   except OSError:
     return  # Silently ignore.
-  sys.stderr.write('info: moving from Recycle Bin: %s\n' % r_pathname)
-  (size, deletion_filetime, deleted_pathname
-  ) = parse_recycle_bin_i_file(pathname)
-  if stat.S_ISREG(stat_obj.st_mode) and size != stat_obj.st_size:
+  # The 'moving from' message is written only later, so errors name the file.
+  try:
+    size, deletion_filetime, pathname_data = _parse_recycle_bin_i_header(pathname)
+  except ValueError:
+    raise ValueError('Bad Recycle Bin $I file %s: %s' % (pathname, sys.exc_info()[1]))
+  if _S_ISREG(stat_obj.st_mode) and size != stat_obj.st_size:
     sys.stderr.write('warning: file size mismatch, not moving: %s\n' % r_pathname)
     return
-  deletion_timestamp = filetime_to_timestamp_float(deletion_filetime)
-  if deletion_timestamp < stat_obj.st_mtime:
-    os.utime(pathname_to_os(r_pathname), (stat_obj.st_atime, deletion_timestamp))
+  try:
+    deleted_pathname = _decode_recycle_bin_i_pathname(pathname_data)
+  except ValueError:
+    raise ValueError('Bad Recycle Bin $I file %s: %s' % (pathname, sys.exc_info()[1]))
+  _set_mtime_if_earlier(_pathname_to_os(r_pathname), stat_obj, deletion_filetime)
   if restore_target_dir == '.':
     restore_pathname = deleted_pathname
   else:
-    restore_pathname = os.path.join(restore_target_dir, deleted_pathname)
-  if os.path.exists(pathname_to_os(restore_pathname)):
-    prefix, ext = os.path.splitext(restore_pathname)
-    i = 1
-    while 1:
-      restore_pathname = '%s-%d%s' % (prefix, i, ext)
-      if not os.path.exists(pathname_to_os(restore_pathname)):
-        break
-      i += 1
-  sys.stderr.write('info: moving to: %s\n' % restore_pathname)
-  restore_dirname = os.path.dirname(restore_pathname)
-  if not os.path.isdir(pathname_to_os(restore_dirname)):
-    os.makedirs(pathname_to_os(restore_dirname))
-  os.rename(pathname_to_os(r_pathname), pathname_to_os(restore_pathname))
-  os.remove(pathname_to_os(pathname))
-
-
-def process_recursively(pathname, restore_target_dir):
-  #print([pathname])
+    restore_pathname = _join(restore_target_dir, deleted_pathname)
+  lock = _RESTORE_LOCK
+  if lock is None:
+    _move_to_restore_pathname(r_pathname, restore_pathname, stat_obj)
+  else:
+    lock.acquire()
+    try:
+      _move_to_restore_pathname(r_pathname, restore_pathname, stat_obj)
+    finally:
+      lock.release()
+  _remove(_pathname_to_os(pathname))
+  _stat_cache.pop(pathname, None)
+
+
+def process_directory(
+    pathname, restore_target_dir, do_sort=False,
+    _list_dir_entries=list_dir_entries,
+    _process_recycle_bin_pathname=process_recycle_bin_pathname):
+  """Restores files from a directory, returns its subdirectories."""
   try:
-    stat_obj = os.lstat(pathname_to_os(pathname))
+    entries = _list_dir_entries(pathname, do_sort)
   except OSError:
-    return  # Silently ignore, probably it's an $R file which has been moved.
-  if stat.S_ISDIR(stat_obj.st_mode):
-    for entry in sorted(pathnames_from_os(os.listdir(pathname_to_os(pathname)))):
-      process_recursively(os.path.join(pathname, entry), restore_target_dir)
-  elif stat.S_ISREG(stat_obj.st_mode):
-    basename = os.path.basename(pathname)
+    return ()  # Silently ignore, probably it's an $R directory which has been moved.
+  subdir_pathnames, i_entries, r_entries = [], [], {}
+  for entry in entries:
+    name = entry.name
+    if name.startswith('$R'):
+      r_entries[name[2:]] = entry
+    if entry.is_dir(follow_symlinks=False):
+      subdir_pathnames.append(entry.path)
+    elif name.startswith('$I') and entry.is_file(follow_symlinks=False):
+      i_entries.append(entry)
+  for i_entry in i_entries:
+    r_entry = r_entries.get(i_entry.name[2:])
+    if r_entry is not None:  # Silently ignore $I files without $R.
+      _process_recycle_bin_pathname(i_entry, r_entry, restore_target_dir)
+  return subdir_pathnames
+
+
+def process_directories(pathnames, restore_target_dir, do_sort=False):
+  pathnames = list(pathnames)  # Stack of directories to visit.
+  pathnames.reverse()  # Visit directories in the specified order.
+  while pathnames:
+    subdir_pathnames = list(process_directory(
+        pathnames.pop(), restore_target_dir, do_sort))
+    subdir_pathnames.reverse()  # Visit subdirectories in listed order.
+    pathnames.extend(subdir_pathnames)
+
+
+def process_directory_job(args):  # Runs in a multiprocessing worker.
+  pathname, restore_target_dir, do_sort = args
+  process_directories((pathname,), restore_target_dir, do_sort)
+
+
+def process_directories_in_parallel(pathnames, restore_target_dir, jobs,
+                                    do_sort=False):
+  """Processes each directory in pathnames recursively in a process pool.
+
+  Typically each directory belongs to a different user SID, so they are
+  independent, and their system calls can overlap. Picking the restore
+  pathname and moving the file there is serialized with _RESTORE_LOCK, so
+  that files from different processes don't overwrite each other.
+  """
+  try:
+    import multiprocessing  # Python >=2.6.
+  except ImportError:
+    multiprocessing = None
+  if multiprocessing is None or jobs <= 1 or len(pathnames) <= 1:
+    process_directories(pathnames, restore_target_dir, do_sort)
+    return
+  pool = multiprocessing.Pool(min(jobs, len(pathnames)), init_worker,
+                              (multiprocessing.Lock(),))
+  try:
+    result = pool.map_async(
+        process_directory_job,
+        [(pathname, restore_target_dir, do_sort) for pathname in pathnames], 1)
+    # Wait with a timeout: in Python 2 an untimed wait blocks KeyboardInterrupt.
+    while not result.ready():
+      result.wait(60)
+    result.get()  # Raises the exception of a failed worker.
+  finally:
+    pool.terminate()  # No-op if map has finished successfully.
+    pool.join()
+
+
+def process_recursively(pathname, restore_target_dir, jobs=1, do_sort=False):
+  #print([pathname])
+  file_type = get_lstat_type(pathname)
+  if file_type == stat.S_IFREG:
+    dirname, basename = os.path.split(pathname)
     if basename.startswith('$I'):
-      process_recycle_bin_pathname(pathname, restore_target_dir)
+      process_recycle_bin_pathname(
+          LstatDirEntry(dirname, basename),
+          LstatDirEntry(dirname, '$R' + basename[2:]), restore_target_dir)
+    return
+  if file_type != stat.S_IFDIR:
+    return  # Also silently ignore missing files.
+  process_directories_in_parallel(
+      process_directory(pathname, restore_target_dir, do_sort),
+      restore_target_dir, jobs, do_sort)
 
 
 def main(argv):
@@ -230,9 +546,17 @@ def main(argv):
         'There is NO WARRANTY. Use at your risk.\n'
         'Usage: %s [<flag> ...] <recycle-bin-dir>\nFlags:\n'
         '--restore-target-dir=<dir>: Restore recycled files to here.\n'
+        '--jobs=<n>: Number of processes for subdirectories. Default: 8.\n'
+        '--deterministic-order: Process files in sorted order, in a single '
+        'process. This\n  makes the -<n> suffixes of restored files with the '
+        'same name reproducible.\n  Default: directory order, in parallel.\n'
         % argv[0])
     sys.exit(1)
   restore_target_dir = '.'
+  jobs = 8
+  # Each $I file is independent, so the order only matters for the -<n>
+  # suffixes added to restore pathnames which are already taken.
+  do_sort = False
   i = 1
   while i < len(argv):
     arg = argv[i]
@@ -244,6 +568,16 @@ def main(argv):
       break
     elif arg.startswith('--restore-target-dir='):
       restore_target_dir = pathname_from_argv(arg[arg.find('=') + 1:])
+    elif arg.startswith('--jobs='):
+      try:
+        jobs = int(arg[arg.find('=') + 1:])
+      except ValueError:
+        jobs = 0
+      if jobs < 1:
+        sys.stderr.write('fatal: bad --jobs= value: %s\n' % arg)
+        sys.exit(1)
+    elif arg == '--deterministic-order':
+      do_sort = True
     else:
       sys.stderr.write('fatal: unknown command-line flag: %s\n' % arg)
       sys.exit(1)
@@ -255,7 +589,9 @@ def main(argv):
   if i != len(argv):
     sys.stderr.write('fatal: too many command-line arguments\n')
     sys.exit(1)
-  process_recursively(pathname, restore_target_dir)
+  if do_sort:
+    jobs = 1  # Parallel processing would make the order nondeterministic.
+  process_recursively(pathname, restore_target_dir, jobs, do_sort)
 
 
 if __name__ == '__main__':